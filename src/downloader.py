@@ -1,7 +1,14 @@
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+import os
 from pathlib import Path
+from queue import Queue
 import shutil
+import tempfile
+from threading import Lock
+from typing import BinaryIO, List
 
-from requests import Session
+from requests import RequestException, Response, Session
 from requests.adapters import HTTPAdapter
 from tqdm import tqdm
 from urllib3.util.retry import Retry
@@ -15,18 +22,205 @@ def _make_session() -> Session:
         status_forcelist=(500, 502, 503, 504),
         allowed_methods=["GET"],
     )
-    s.mount("https://", HTTPAdapter(max_retries=retry))
+    # 连接池大小按共用该 session 的并发请求数设置
+    s.mount("https://", HTTPAdapter(pool_maxsize=32, max_retries=retry))
     return s
 
 
 SESSION = _make_session()
+# 连接/读取超时（秒），避免卡住的连接一直占用线程池
+TIMEOUT = 30
+WHEELS_DIR = Path("wheels")
+# 超过该大小的文件分段并行下载
+PARALLEL_MIN_SIZE = 256 << 20
 
 
-def download_package(data: dict) -> Path:
-    wheels_dir = Path("wheels")
-    wheels_dir.mkdir(exist_ok=True, parents=True)
+def _default_file_mode() -> int:
+    # mkstemp 创建的文件权限为 0600，按 umask 还原为普通文件的权限
+    umask = os.umask(0)
+    os.umask(umask)
+    return 0o666 & ~umask
+
+
+FILE_MODE = _default_file_mode()
+
+
+def write_file_atomic(file: Path, data: bytes, skip_unchanged: bool = True):
+    # 内容未变化时不重写；否则写入同目录下唯一的临时文件再重命名，
+    # 进程中断不会留下写了一半的文件，并发写入也互不干扰
+    if skip_unchanged and file.exists() and file.read_bytes() == data:
+        return
+    fd, tmp_name = tempfile.mkstemp(dir=file.parent, prefix=f"{file.name}.", suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        os.chmod(tmp_name, FILE_MODE)
+        os.replace(tmp_name, file)
+    except BaseException:
+        Path(tmp_name).unlink(missing_ok=True)
+        raise
+
+
+class HttpRangeFile:
+    """
+    只读、可 seek 的远程文件，按需用 HTTP Range 请求读取，供 zipfile 读取
+    wheel 的目录和单个文件而不下载整个 wheel
+    """
+
+    def __init__(self, url: str, size: int, block_size: int = 1 << 16,
+                 tail: bytes | None = None):
+        self.url = url
+        self.size = size
+        self.block_size = block_size
+        self.pos = 0
+        self.blocks = []
+        # zip 的 end of central directory 在文件末尾，预先读取
+        if tail is not None:
+            self.blocks.append((size - len(tail), tail))
+        else:
+            self._fetch(max(size - block_size, 0), size)
+
+    def _fetch(self, start: int, end: int) -> bytes:
+        headers = {
+            "Range": f"bytes={start}-{end - 1}",
+            "Accept-Encoding": "identity",
+        }
+        resp = SESSION.get(self.url, headers=headers, timeout=TIMEOUT)
+        resp.raise_for_status()
+        if resp.status_code != 206:
+            raise ValueError(f"Range request not supported by {self.url}")
+        data = resp.content
+        self.blocks.append((start, data))
+        return data
+
+    def seekable(self) -> bool:
+        return True
+
+    def tell(self) -> int:
+        return self.pos
+
+    def seek(self, offset: int, whence: int = os.SEEK_SET) -> int:
+        if whence == os.SEEK_CUR:
+            offset += self.pos
+        elif whence == os.SEEK_END:
+            offset += self.size
+        if offset < 0:
+            raise OSError(f"Invalid seek position {offset}")
+        self.pos = offset
+        return self.pos
+
+    def read(self, n: int = -1) -> bytes:
+        start = self.pos
+        end = self.size if n < 0 else min(start + n, self.size)
+        if start >= end:
+            return b""
+        self.pos = end
+        for block_start, data in self.blocks:
+            if block_start <= start and end <= block_start + len(data):
+                return data[start - block_start:end - block_start]
+        data = self._fetch(start, min(max(end, start + self.block_size), self.size))
+        return data[:end - start]
+
+
+def open_remote_file(url: str, min_range_size: int = 1 << 20,
+                     block_size: int = 1 << 16) -> BinaryIO:
+    resp = SESSION.head(url, allow_redirects=True, timeout=TIMEOUT,
+                        headers={"Accept-Encoding": "identity"})
+    resp.raise_for_status()
+    size = resp.headers.get("Content-Length")
+    if size is not None and int(size) < min_range_size:
+        # 已知的小文件直接整个读取
+        resp = SESSION.get(url, headers={"Accept-Encoding": "identity"}, timeout=TIMEOUT)
+        resp.raise_for_status()
+        return BytesIO(resp.content)
+
+    # 大小未知或较大时不信任 HEAD，用 Range 请求读取文件末尾，
+    # 同时从 Content-Range 得到文件大小，绝不把整个 wheel 读进内存
+    headers = {
+        "Range": f"bytes=-{block_size}",
+        "Accept-Encoding": "identity",
+    }
+    with SESSION.get(url, stream=True, headers=headers, timeout=TIMEOUT) as resp:
+        resp.raise_for_status()
+        content_range = resp.headers.get("Content-Range", "")
+        total = content_range.split("/")[-1]
+        if resp.status_code != 206 or not total.isdigit():
+            raise ValueError(f"Range request not supported by {url}")
+        tail = resp.content
+    return HttpRangeFile(resp.url, int(total), block_size, tail)
+
+
+def _download_ranges(url: str, tmp_file: Path, total_size: int, pbar: tqdm,
+                     n: int = 4, retries: int = 3):
+    part_size = -(-total_size // n)
+    pbar_lock = Lock()
+    fd = os.open(tmp_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC)
+    try:
+        if hasattr(os, "posix_fallocate"):
+            try:
+                os.posix_fallocate(fd, 0, total_size)
+            except OSError:
+                pass
+
+        def download_range(start: int):
+            end = min(start + part_size, total_size)
+            offset = start
+            # 连接中断时从已写入的位置重试该段
+            for _ in range(retries):
+                headers = {
+                    "Range": f"bytes={offset}-{end - 1}",
+                    "Accept-Encoding": "identity",
+                }
+                try:
+                    with SESSION.get(url, stream=True, headers=headers, timeout=TIMEOUT) as resp:
+                        resp.raise_for_status()
+                        if resp.status_code != 206:
+                            raise ValueError(f"Range request not supported by {url}")
+                        for chunk in resp.iter_content(chunk_size=1 << 20):
+                            os.pwrite(fd, chunk, offset)
+                            offset += len(chunk)
+                            with pbar_lock:
+                                pbar.update(len(chunk))
+                except RequestException:
+                    pass
+                if offset == end:
+                    return
+            raise ValueError(f"Incomplete range {start}-{end - 1} of {url}")
+
+        with ThreadPoolExecutor(max_workers=n) as executor:
+            list(executor.map(download_range, range(0, total_size, part_size)))
+    except BaseException:
+        # 分段写入的文件无法按长度续传，失败后整个删除
+        os.close(fd)
+        tmp_file.unlink(missing_ok=True)
+        raise
+    os.close(fd)
+
+
+def _write_stream(resp: Response, tmp_file: Path, download_size: int, total_size: int, pbar: tqdm):
+    with open(tmp_file, "r+b" if download_size > 0 else "wb") as f:
+        if hasattr(os, "posix_fallocate") and total_size > download_size:
+            # 一次性预分配剩余空间，避免大文件边写边分配
+            try:
+                os.posix_fallocate(
+                    f.fileno(), download_size, total_size - download_size)
+            except OSError:
+                pass
+        f.seek(download_size)
+        try:
+            for chunk in resp.iter_content(chunk_size=1 << 20):
+                f.write(chunk)
+                download_size += len(chunk)
+                pbar.update(len(chunk))
+        finally:
+            # 未下载完时去掉预分配的部分，续传从实际写入的位置开始
+            f.truncate(download_size)
+
+
+def download_package(data: dict, position: int | None = None) -> Path:
+    WHEELS_DIR.mkdir(exist_ok=True, parents=True)
     pkg_name: str = data["name"]
-    filepath = wheels_dir / pkg_name
+    filepath = WHEELS_DIR / pkg_name
     if filepath.exists():
         print(f"Already downloaded {pkg_name}")
         return filepath
@@ -52,8 +246,22 @@ def download_package(data: dict) -> Path:
                 "Accept-Encoding": "identity",
             }
 
-        with SESSION.get(data["url"], stream=True, headers=headers) as resp:
+        resp = SESSION.get(data["url"], stream=True, headers=headers, timeout=TIMEOUT)
+        if resp.status_code == 416:
+            # 临时文件长度不可信（如预分配后进程被杀），删除后从头下载
+            resp.close()
+            tmp_file.unlink()
+            download_size = 0
+            headers = {
+                "Accept-Encoding": "identity",
+            }
+            resp = SESSION.get(data["url"], stream=True, headers=headers, timeout=TIMEOUT)
+
+        with resp:
             resp.raise_for_status()
+            if resp.status_code != 206:
+                # 服务器未按 Range 返回，从头下载
+                download_size = 0
             # print(f"Content-Range: {resp.headers.get('Content-Range')}")
             # print(f"Content-Length: {resp.headers.get('Content-Length')}")
 
@@ -63,17 +271,37 @@ def download_package(data: dict) -> Path:
             else:
                 total_size = int(resp.headers.get("Content-Length", 0))
 
-            chunk_size = 4096
             print(f"Downloading {data['name']}")
             pbar = tqdm(
-                total=total_size, unit="B", unit_scale=True)
+                total=total_size, unit="B", unit_scale=True,
+                desc=pkg_name, position=position, leave=position is None)
             pbar.update(download_size)
 
-            with open(tmp_file, "ab") as f:
-                for chunk in resp.iter_content(chunk_size=chunk_size):
-                    f.write(chunk)
-                    download_size += len(chunk)
-                    pbar.update(len(chunk))
+            if download_size == 0 and total_size >= PARALLEL_MIN_SIZE and \
+                    resp.headers.get("Accept-Ranges") == "bytes" and hasattr(os, "pwrite"):
+                # 单连接跑不满带宽，改为多个 Range 请求并行下载
+                # 分段写入的文件有空洞，用单独的文件名，不会被当作可续传的临时文件
+                resp.close()
+                ranges_file = tmp_dir / f"{pkg_name}.ranges"
+                try:
+                    _download_ranges(data["url"], ranges_file, total_size, pbar)
+                    pbar.close()
+                    shutil.move(ranges_file, filepath)
+                    return filepath
+                except (RequestException, ValueError):
+                    # 分段重试后仍失败，改用可续传的单连接下载
+                    pbar.reset(total=total_size)
+                headers = {
+                    "Accept-Encoding": "identity",
+                }
+                with SESSION.get(data["url"], stream=True, headers=headers, timeout=TIMEOUT) as resp:
+                    resp.raise_for_status()
+                    _write_stream(resp, tmp_file, 0, total_size, pbar)
+                pbar.close()
+                shutil.move(tmp_file, filepath)
+                return filepath
+
+            _write_stream(resp, tmp_file, download_size, total_size, pbar)
             pbar.close()
             shutil.move(tmp_file, filepath)
             return filepath
@@ -84,6 +312,23 @@ def download_package(data: dict) -> Path:
     return None
 
 
+def download_packages(datas: List[dict], max_workers: int = 4) -> List[Path]:
+    # 同时保持几个下载流，每个下载占用一行空闲的进度条
+    positions = Queue()
+    for i in range(max_workers):
+        positions.put(i)
+
+    def download(data: dict) -> Path:
+        position = positions.get()
+        try:
+            return download_package(data, position)
+        finally:
+            positions.put(position)
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        return list(executor.map(download, datas))
+
+
 if __name__ == "__main__":
     print(download_package({
         "name": "testa.whl",
@@ -5,10 +5,10 @@ from typing import Dict, List
 from packaging.specifiers import SpecifierSet
 from packaging.version import Version
 
-from downloader import download_package
+from downloader import download_packages
 from python_environment import get_python_environment
-from wheel_index import get_suitable_package, get_wheel_index
-from wheel_parse import parse_package_version_str, parse_wheels_dependency
+from wheel_index import get_suitable_package, get_wheel_indexes, normalize_name
+from wheel_parse import get_wheels_dependencies, get_wheels_dependency, parse_package_version_str
 from wheel_tags import get_compat_wheel_tags, load_linux_x86_64_platforms
 
 
@@ -24,6 +24,15 @@ def check_package_dependency(pkg_dep: Dict, extra: List[str], py_env: Dict) -> b
     return True
 
 
+def check_package_resolved(pkg_req: Dict, resolved: tuple | None) -> bool:
+    # resolved again when a later dependant tightened the version or added extras
+    if resolved is None:
+        return False
+    resolved_pkg, resolved_extra = resolved
+    return pkg_req["package_version"].contains(resolved_pkg["package_version"]) and \
+        resolved_extra.issuperset(pkg_req["package_extra"])
+
+
 if __name__ == "__main__":
     # input
     # large package file that too slow to download
@@ -51,71 +60,40 @@ if __name__ == "__main__":
             ver_spec = SpecifierSet()
         else:
             ver_spec = SpecifierSet(v)
-        new_req[pkg_name] = {"package_extra": extra,
-                             "package_version": ver_spec}
+        new_req[normalize_name(pkg_name)] = {"package_extra": extra,
+                                             "package_version": ver_spec}
 
     compat_tags = get_compat_wheel_tags(py_ver, load_linux_x86_64_platforms())
     py_env = get_python_environment(py_ver)
     py_ver = Version(py_ver)
 
-    # download root package
-    req_pkg_names = list(new_req.keys())
-    dep_pkg_names = []
-    for pkg_name in req_pkg_names:
-        ver_spec = new_req[pkg_name]["package_version"]
-        pkg_extra = new_req[pkg_name]["package_extra"]
-        pkg_index = get_wheel_index(pkg_name)
-        best_match, candidate = get_suitable_package(
-            pkg_name, pkg_index, ver_spec, compat_tags)
-        pkg_path = download_package(best_match)
-        if pkg_path.suffix == ".whl":
-            py_dep, pkg_deps = parse_wheels_dependency(pkg_path)
-            if not py_dep.contains(py_ver):
-                raise ValueError(
-                    f"Package requires python version {py_dep}, but current python version is {py_env}")
-            req_deps = []
-            for pkg_dep in pkg_deps:
-                if check_package_dependency(pkg_dep, pkg_extra, py_env):
-                    req_deps.append(pkg_dep)
-
-            print(
-                f"Package {pkg_name} {best_match['package_version']} requires:")
-            for dep in req_deps:
-                dep_name = dep["package_name"]
-                dep_extra = dep["package_extra"]
-                dep_ver = dep["package_version"]
-                dep_pkg_names.append(dep_name)
-                print(
-                    f"\t{dep_name} {dep_ver}")
-
-                if dep_name in new_req:
-                    new_req[dep_name]["package_extra"] = list(
-                        set(new_req[dep_name]["package_extra"] + dep_extra))
-                    new_req[dep_name]["package_version"] &= dep_ver
-                else:
-                    new_req[dep_name] = {
-                        "package_extra": dep_extra,
-                        "package_version": dep_ver
-                    }
-            print()
-
-    # download dependency packages
-    while len(dep_pkg_names) > 0:
-        pkg_name = dep_pkg_names.pop(0)
-        pkg_spec = new_req[pkg_name]["package_version"]
-        pkg_extra = new_req[pkg_name]["package_extra"]
-        pkg_index = get_wheel_index(pkg_name)
-        best_match, candidate = get_suitable_package(
-            pkg_name, pkg_index, pkg_spec, compat_tags)
-
-        while True:
-            pkg_path = download_package(best_match)
-            py_dep, pkg_deps = parse_wheels_dependency(pkg_path)
-            if not py_dep.contains(py_ver):
+    # pkg_name -> (resolved package, extras its dependencies were expanded with)
+    resolved_pkgs = {}
+    pkg_names = list(new_req.keys())
+    while len(pkg_names) > 0:
+        pkg_names = [pkg_name for pkg_name in dict.fromkeys(pkg_names)
+                     if not check_package_resolved(new_req[pkg_name], resolved_pkgs.get(pkg_name))]
+        pkg_indexes = get_wheel_indexes(pkg_names)
+        pkg_matches = [
+            get_suitable_package(pkg_name, pkg_indexes[pkg_name],
+                                 new_req[pkg_name]["package_version"], compat_tags)
+            for pkg_name in pkg_names
+        ]
+        pkg_wheel_deps = get_wheels_dependencies(
+            [best_match for best_match, _ in pkg_matches])
+
+        next_pkg_names = []
+        for pkg_name, (best_match, candidate), (py_dep, pkg_deps) in zip(pkg_names, pkg_matches, pkg_wheel_deps):
+            pkg_spec = new_req[pkg_name]["package_version"]
+            pkg_extra = new_req[pkg_name]["package_extra"]
+            while not py_dep.contains(py_ver):
                 print(
                     f"Package {pkg_name} {pkg_spec} requires python version {py_dep}, but current python version is {py_ver}, try next version")
+                if len(candidate) == 0:
+                    raise ValueError(
+                        f"No package of {pkg_name} {pkg_spec} supports python version {py_ver}")
                 best_match = candidate.pop(-1)
-                continue
+                py_dep, pkg_deps = get_wheels_dependency(best_match)
 
             req_deps = []
             for pkg_dep in pkg_deps:
@@ -125,16 +103,16 @@ if __name__ == "__main__":
             print(
                 f"Package {pkg_name} {best_match['package_version']} requires:")
             for dep in req_deps:
-                dep_name = dep["package_name"]
+                dep_name = normalize_name(dep["package_name"])
                 dep_extra = dep["package_extra"]
                 dep_ver = dep["package_version"]
-                dep_pkg_names.append(dep_name)
+                next_pkg_names.append(dep_name)
                 print(
                     f"\t{dep_name} {dep_ver}")
 
                 if dep_name in new_req:
                     new_req[dep_name]["package_extra"] = list(
-                        set(new_req[dep_name]["package_extra"] + dep_extra))
+                        set(new_req[dep_name]["package_extra"]).union(dep_extra))
                     new_req[dep_name]["package_version"] &= dep_ver
                 else:
                     new_req[dep_name] = {
@@ -142,6 +120,12 @@ if __name__ == "__main__":
                         "package_version": dep_ver
                     }
             print()
-            break
-
-    pass
+            resolved_pkgs[pkg_name] = (best_match, set(pkg_extra))
+        pkg_names = next_pkg_names
+
+    # only download once the whole dependency closure is resolved
+    pkgs = [pkg for pkg, _ in resolved_pkgs.values()]
+    pkg_paths = download_packages(pkgs)
+    failed = [pkg["name"] for pkg, path in zip(pkgs, pkg_paths) if path is None]
+    if len(failed) > 0:
+        raise ValueError(f"Failed to download: {', '.join(failed)}")
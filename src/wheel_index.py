@@ -1,16 +1,24 @@
-from copy import deepcopy
-from functools import reduce
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from itertools import chain
 import json
 from pathlib import Path
-from typing import Callable, Dict, List
-from urllib.parse import urlparse
+import pickle
+from typing import Dict, FrozenSet, Iterator, List, Tuple
+from urllib.parse import urljoin
 
-from bs4 import BeautifulSoup
+from lxml import etree
 from packaging.specifiers import SpecifierSet
 from packaging.tags import Tag, parse_tag
 from packaging.utils import InvalidWheelFilename, parse_wheel_filename
 from packaging.version import InvalidVersion, Version
-import requests
+
+from downloader import SESSION, TIMEOUT, write_file_atomic
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 INDEX_URL = "https://mirrors.aliyun.com/pypi/simple/"
 TORCH_FIND_LINKS_CU118 = "https://mirrors.aliyun.com/pytorch-wheels/cu118/"
@@ -18,125 +26,179 @@ TORCH_FIND_LINKS_CU126 = "https://mirrors.aliyun.com/pytorch-wheels/cu126/"
 TORCH_FIND_LINKS_CU128 = "https://mirrors.aliyun.com/pytorch-wheels/cu128/"
 CACHE_INDEX = {}
 
+# versions and tags repeat across an index, parse each one once
+cached_version = lru_cache(maxsize=4096)(Version)
+cached_parse_tag = lru_cache(maxsize=4096)(parse_tag)
+
+
+def parse_file_name(file_name: str, pkg_name: str) -> Dict | None:
+    if file_name.endswith(".tar.gz"):
+        try:
+            version = Version(file_name[len(pkg_name)+1:-7].split("-")[0])
+        except InvalidVersion:
+            return None
+        return {
+            "package_name": pkg_name,
+            "package_version": version,
+            "tags": None,
+            "extension": "tar.gz"
+        }
+    if file_name.endswith(".whl"):
+        try:
+            _, version, _, tags = parse_wheel_filename(file_name)
+            tags = list(tags)
+        except InvalidWheelFilename:
+            return None
+        return {
+            "package_name": pkg_name,
+            "package_version": version,
+            "tags": tags,
+            "extension": "whl"
+        }
+    return None
+
+
+def normalize_name(pkg_name: str) -> str:
+    return pkg_name.lower().replace("_", "-")
+
+
+def filter_package(name: str, norm_name: str) -> bool:
+    # norm_name is normalize_name(pkg_name), computed once per index page
+    if not name.endswith((".whl", ".tar.gz")):
+        return False
+    # only the distribution name before the first "-" is compared
+    prefix, sep, _ = name.partition("-")
+    return bool(sep) and normalize_name(prefix) == norm_name
+
+
+def iter_index_links(url: str) -> Iterator[Tuple[str, str]]:
+    # feed the page into lxml as it arrives and only emit <a> elements
+    parser = etree.HTMLPullParser(
+        events=("end",), tag="a", collect_ids=False, remove_comments=True)
+    with SESSION.get(url, stream=True, timeout=TIMEOUT) as response:
+        response.raise_for_status()
+        for chunk in response.iter_content(chunk_size=1 << 16):
+            parser.feed(chunk)
+            for _, elem in parser.read_events():
+                yield elem.text or "", elem.get("href") or ""
+                elem.clear()
+    parser.close()
+    for _, elem in parser.read_events():
+        yield elem.text or "", elem.get("href") or ""
+
+
+def get_index_by_url(pkg_name: str, url: str, link_base: str) -> List[Dict]:
+    # absolute hrefs are kept as is, relative ones are resolved against link_base
+    norm_name = normalize_name(pkg_name)
+    package_data = []
+    for name, href in iter_index_links(url):
+        if not filter_package(name, norm_name):
+            continue
+        package = parse_file_name(name, pkg_name)
+        if package is None:
+            continue
+        link = {"name": name,
+                "url": href if href.startswith(("http://", "https://")) else urljoin(link_base, href)}
+        link.update(package)
+        package_data.append(link)
 
-def get_parse_file_name_func(pkg_name: str) -> Callable:
-    def parse_file_name(file_name: str) -> Dict | None:
-        if file_name.endswith(".tar.gz"):
-            try:
-                version = Version(file_name[len(pkg_name)+1:-7].split("-")[0])
-            except InvalidVersion:
-                return None
-            return {
-                "package_name": pkg_name,
-                "package_version": version,
-                "tags": None,
-                "extension": "tar.gz"
-            }
-        if file_name.endswith(".whl"):
-            try:
-                _, version, _, tags = parse_wheel_filename(file_name)
-                tags = list(tags)
-            except InvalidWheelFilename:
-                return None
-            return {
-                "package_name": pkg_name,
-                "package_version": version,
-                "tags": tags,
-                "extension": "whl"
-            }
-        return None
-    return parse_file_name
+    return package_data
 
 
-def get_filter_package_func(pkg_name: str) -> Callable:
-    def filter_package(x):
-        name = x["name"]
-        if not name.endswith(".whl") and not name.endswith(".tar.gz"):
-            return False
-        name_sep = name.split("-")
-        if len(name_sep) < 1:
-            return False
-        if name_sep[0].lower().replace("_", "-") != pkg_name.lower().replace("_", "-"):
-            return False
-        return True
-    return filter_package
+def get_index_by_find_links(pkg_name: str, find_links: str) -> List[Dict]:
+    return get_index_by_url(pkg_name, find_links, find_links)
 
 
-def get_index_by_find_links(pkg_name: str, find_links: str) -> List[Dict]:
-    url = find_links
-    response = requests.get(url)
-    response.raise_for_status()
-    text = response.text
-    soup = BeautifulSoup(text, "html.parser")
-    links = soup.find_all("a")
-    links_data = [
-        {"name": link.text, "url": f"{url}{link.get('href')}"} for link in links]
-
-    links_data = list(filter(get_filter_package_func(pkg_name), links_data))
-
-    package_data = [
-        get_parse_file_name_func(pkg_name)(link["name"]) for link in links_data
-    ]
-    package_data = [
-        {**link, **package} for link, package in zip(links_data, package_data) if package is not None
-    ]
+def get_index_by_index_url(pkg_name: str, index_url: str) -> List[Dict]:
+    url = f"{index_url}{normalize_name(pkg_name)}"
+    return get_index_by_url(pkg_name, url, f"{url}/")
 
-    return package_data
 
+def load_index_file(index_file: Path) -> List[Dict]:
+    if orjson is not None:
+        return orjson.loads(index_file.read_bytes())
+    with index_file.open("r", encoding="utf-8") as f:
+        return json.load(f)
 
-def get_index_by_index_url(pkg_name: str, index_url: str) -> List[Dict]:
-    url = f"{index_url}{pkg_name.lower().replace('_', '-')}"
-    response = requests.get(url)
-    response.raise_for_status()
-    text = response.text
-    soup = BeautifulSoup(text, "html.parser")
-    links = soup.find_all("a")
-    links_data = [
-        {"name": link.text, "url": f"{url}/{link.get('href')}"} for link in links]
-
-    links_data = list(filter(get_filter_package_func(pkg_name), links_data))
-
-    package_data = [
-        get_parse_file_name_func(pkg_name)(link["name"]) for link in links_data
-    ]
-    package_data = [
-        {**link, **package} for link, package in zip(links_data, package_data) if package is not None
-    ]
 
-    return package_data
+def dump_index_file(index_file: Path, index_json: List[Dict]):
+    if orjson is not None:
+        data = orjson.dumps(index_json, option=orjson.OPT_INDENT_2)
+    else:
+        data = json.dumps(index_json, indent=4).encode("utf-8")
+    write_file_atomic(index_file, data)
+
+
+def encode_tags(tags: List[Tag] | None) -> List[str] | None:
+    return None if tags is None else list(map(str, tags))
+
+
+def decode_tags(tags: List[str] | None) -> List[Tag] | None:
+    return None if tags is None else \
+        list(chain.from_iterable(map(cached_parse_tag, tags)))
+
+
+def load_index_pickle(pickle_file: Path, index_file: Path) -> List[Dict] | None:
+    # the pickle holds already parsed Version objects, it is only trusted
+    # while it is at least as new as the JSON file it was made from
+    if not pickle_file.exists() or \
+            pickle_file.stat().st_mtime < index_file.stat().st_mtime:
+        return None
+    try:
+        with pickle_file.open("rb") as f:
+            index_data = pickle.load(f)
+        return [{**x, "tags": decode_tags(x["tags"])} for x in index_data]
+    except Exception:
+        # written in an older format or by an incompatible packaging version,
+        # fall back to the JSON
+        return None
+
+
+def dump_index_pickle(pickle_file: Path, index_data: List[Dict]):
+    # before packaging 26.2 a pickled Tag keeps its precomputed str hash,
+    # which is wrong in any other process, so tags are stored as strings
+    index_data = [{**x, "tags": encode_tags(x["tags"])} for x in index_data]
+    # always rewritten, its mtime must end up newer than the JSON file
+    write_file_atomic(pickle_file, pickle.dumps(
+        index_data, protocol=5), skip_unchanged=False)
 
 
 def get_wheel_index(pkg_name: str):
     global CACHE_INDEX
 
-    cache_key = pkg_name.lower().replace("_", "-")
+    cache_key = normalize_name(pkg_name)
     if cache_key in CACHE_INDEX:
         return CACHE_INDEX[cache_key]
 
     index_dir = Path("index")
 
     def decode_index_data(x):
-        x = deepcopy(x)
-        x["package_version"] = Version(x["package_version"])
-        if x["tags"] is not None:
-            x["tags"] = list(map(parse_tag, x["tags"]))
-            x["tags"] = reduce(lambda x, y: list(x)+list(y), x["tags"])
-        else:
-            x["tags"] = None
-        return x
+        # rows are flat, a new dict per row is enough to keep the input intact
+        return {
+            **x,
+            "package_version": cached_version(x["package_version"]),
+            "tags": decode_tags(x["tags"]),
+        }
 
     index_file = index_dir / f"{cache_key}.json"
+    pickle_file = index_dir / f"{cache_key}.pkl"
     if index_file.exists():
-        with index_file.open("r", encoding="utf-8") as f:
-            index_json = json.load(f)
-        index_data = list(map(decode_index_data, index_json))
+        index_data = load_index_pickle(pickle_file, index_file)
+        if index_data is None:
+            index_json = load_index_file(index_file)
+            index_data = list(map(decode_index_data, index_json))
+            dump_index_pickle(pickle_file, index_data)
         CACHE_INDEX[cache_key] = index_data
         return index_data
 
     if pkg_name in ["torch", "torchvision", "torchaudio"]:
-        index_data = get_index_by_find_links(pkg_name, TORCH_FIND_LINKS_CU118) + \
-            get_index_by_find_links(pkg_name, TORCH_FIND_LINKS_CU126) + \
-            get_index_by_find_links(pkg_name, TORCH_FIND_LINKS_CU128)
+        # the mirrors are independent, fetch them at the same time
+        find_links = [TORCH_FIND_LINKS_CU118,
+                      TORCH_FIND_LINKS_CU126, TORCH_FIND_LINKS_CU128]
+        with ThreadPoolExecutor(max_workers=len(find_links)) as executor:
+            index_parts = executor.map(
+                lambda x: get_index_by_find_links(pkg_name, x), find_links)
+            index_data = [x for part in index_parts for x in part]
     else:
         index_data = get_index_by_index_url(pkg_name, INDEX_URL)
 
@@ -144,51 +206,52 @@ def get_wheel_index(pkg_name: str):
     index_data.sort(key=lambda x: x["package_version"])
 
     def encode_index_data(x):
-        x = deepcopy(x)
-        x["package_version"] = str(x["package_version"])
-        if x["tags"] is not None:
-            x["tags"] = list(map(str, x["tags"]))
-        return x
+        return {
+            **x,
+            "package_version": str(x["package_version"]),
+            "tags": encode_tags(x["tags"]),
+        }
 
-    CACHE_INDEX[pkg_name] = index_data
+    CACHE_INDEX[cache_key] = index_data
 
     index_dir.mkdir(parents=True, exist_ok=True)
     index_json = list(map(encode_index_data, index_data))
-    with index_file.open("w", encoding="utf-8") as f:
-        json.dump(index_json, f, indent=4)
+    dump_index_file(index_file, index_json)
+    dump_index_pickle(pickle_file, index_data)
 
     return index_data
 
 
+def get_wheel_indexes(pkg_names: List[str], max_workers: int = 16) -> Dict[str, List[Dict]]:
+    # index fetching is network bound, fan the requests out over a thread pool
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        index_data = list(executor.map(get_wheel_index, pkg_names))
+    return dict(zip(pkg_names, index_data))
+
+
 def get_suitable_package(pkg_name: str,
                          pkg_index: List[Dict],
                          pkg_ver_spec: SpecifierSet,
-                         sys_prof: List[Tag]) -> (List[Dict], List[Dict]):
+                         sys_prof: FrozenSet[Tag]) -> (List[Dict], List[Dict]):
+    # many files share one version, so check each distinct version only once;
+    # prereleases=False also drops pre and dev releases
+    pkg_vers = {x["package_version"] for x in pkg_index}
+    if len(pkg_ver_spec) == 0:
+        # "latest", no specifier to match against
+        suitable_vers = {ver for ver in pkg_vers if not ver.is_prerelease}
+    else:
+        suitable_vers = set(pkg_ver_spec.filter(pkg_vers, prereleases=False))
+
     def filter_by_tag(x: Dict) -> bool:
         if x["tags"] is None:
             return True
-        for tag in x["tags"]:
-            if tag in sys_prof:
-                return True
-        return False
-
-    filt_pa = list(filter(filter_by_tag, pkg_index))
-
-    def filter_by_version(x: Dict) -> bool:
-        ver = x["package_version"]
-        if ver.is_prerelease:
-            return False
-        if ver.is_devrelease:
-            return False
-        return pkg_ver_spec.contains(ver)
-
-    filt_pa = list(filter(filter_by_version, filt_pa))
-
-    # only consider wheel package
-    def filter_by_extrension(x: Dict) -> bool:
-        return x["extension"] == "whl"
+        return any(tag in sys_prof for tag in x["tags"])
 
-    filt_pa = list(filter(filter_by_extrension, filt_pa))
+    # single pass, cheapest checks first; only consider wheel package
+    filt_pa = [x for x in pkg_index
+               if x["extension"] == "whl"
+               and x["package_version"] in suitable_vers
+               and filter_by_tag(x)]
 
     if len(filt_pa) == 0:
         raise ValueError(
@@ -1,28 +1,51 @@
+from concurrent.futures import ThreadPoolExecutor
+from email.parser import HeaderParser
+from functools import lru_cache
+import json
 from pathlib import Path
 import re
-from typing import Dict, List
+from typing import BinaryIO, List, Tuple
+import zipfile
 
 from packaging.markers import Marker, default_environment
 from packaging.specifiers import SpecifierSet, Version
-import pkginfo
+from requests import RequestException
 
+from downloader import WHEELS_DIR, download_package, open_remote_file, write_file_atomic
 
-def parse_package_version_str(dep: str) -> Dict[str, List[str] | str]:
+METADATA_DIR = Path("index") / "metadata"
+
+# 相同的依赖声明、版本约束和 marker 在不同 wheel 中反复出现，解析结果缓存后只读共享
+cached_specifier_set = lru_cache(maxsize=4096)(SpecifierSet)
+cached_marker = lru_cache(maxsize=4096)(Marker)
+
+PKG_PAT = re.compile(
+    r"^(?P<package_name>[A-Za-z0-9_\-]+)(?:\[(?P<extra_name>[A-Za-z0-9_\-,]+)\])?"
+)
+VER_PAT = re.compile(
+    r"""                   # 例:  (==1.2.3)  >=1.0   <2.0,>=1.5
+    [\s(]*             # 前导空白或左括号
+    (?P<constraint>    # 捕获整个约束串
+        (?:==|!=|~=|>=|<=|>|<)\s*[^,)\s]+  # 单个约束
+        (?:\s*,\s*(?:==|!=|~=|>=|<=|>|<)\s*[^,)\s]+)*  # 后续约束
+    )
+    [\s)]*             # 尾随空白或右括号
+    """,
+    re.VERBOSE,
+)
+
+
+@lru_cache(maxsize=4096)
+def parse_package_version_str(dep: str) -> Tuple[str, Tuple[str, ...], SpecifierSet]:
     """
     解析 wheels / requirements 风格的依赖声明，返回
-        {
-          "package_name": str,
-          "package_version": List[str] | "latest",
-        }
+        (package_name: str, extra: Tuple[str, ...], ver_spec: SpecifierSet)
     """
     dep = dep.strip()
     if not dep:
         raise ValueError("Empty dependency string")
 
-    pkg_pat = re.compile(
-        r"^(?P<package_name>[A-Za-z0-9_\-]+)(?:\[(?P<extra_name>[A-Za-z0-9_\-,]+)\])?"
-    )
-    pkg_mat = pkg_pat.match(dep)
+    pkg_mat = PKG_PAT.match(dep)
     if pkg_mat:
         package_name = pkg_mat.group('package_name')
         extra_name = pkg_mat.group('extra_name')
@@ -32,44 +55,80 @@ def parse_package_version_str(dep: str) -> Dict[str, List[str] | str]:
     else:
         raise ValueError(f"Cannot find package name in: {dep}")
 
-    extra = [extra_name.strip()
-             for extra_name in extra_name.split(",") if extra_name.strip()]
-
-    ver_pat = re.compile(
-        r"""                   # 例:  (==1.2.3)  >=1.0   <2.0,>=1.5
-        [\s(]*             # 前导空白或左括号
-        (?P<constraint>    # 捕获整个约束串
-            (?:==|!=|~=|>=|<=|>|<)\s*[^,)\s]+  # 单个约束
-            (?:\s*,\s*(?:==|!=|~=|>=|<=|>|<)\s*[^,)\s]+)*  # 后续约束
-        )
-        [\s)]*             # 尾随空白或右括号
-        """,
-        re.VERBOSE,
-    )
+    extra = tuple(extra_name.strip()
+                  for extra_name in extra_name.split(",") if extra_name.strip())
 
     # 2️⃣ 查找版本约束（可能在括号内，也可能直接跟在包名后）
-    version_match = ver_pat.search(dep[len(full_name):])
+    version_match = VER_PAT.search(dep[len(full_name):])
     if version_match:
         constraints_str = version_match.group("constraint")
-        ver_spec = SpecifierSet(constraints_str)
+        ver_spec = cached_specifier_set(constraints_str)
     else:
-        ver_spec = SpecifierSet()
+        ver_spec = cached_specifier_set("")
 
     # print(f"{dep} -> '{package_name}' '{extra}' '{ver_spec}'")
     return package_name, extra, ver_spec
 
 
-def parse_wheels_dependency(filepath: Path) -> dict:
-    whl = pkginfo.wheel.Wheel(filepath)
-    deps_str = whl.requires_dist
-    py_dep = whl.requires_python
+def read_wheel_metadata(filepath: Path | BinaryIO) -> str:
+    # 只需要顶层的 .dist-info/METADATA，不读取 wheel 的其余部分
+    with zipfile.ZipFile(filepath) as whl:
+        for name in whl.namelist():
+            if name.endswith(".dist-info/METADATA") and name.count("/") == 1:
+                return whl.read(name).decode("utf-8")
+    raise ValueError(f"Cannot find METADATA in: {filepath}")
+
+
+def read_wheel_requires(metadata: str) -> dict:
+    # 只解析头部，不解析正文中的长描述
+    msg = HeaderParser().parsestr(metadata)
+    return {
+        "requires_python": msg.get("Requires-Python"),
+        "requires_dist": msg.get_all("Requires-Dist", []),
+    }
+
+
+def load_wheel_requires(name: str, url: str) -> dict:
+    # wheel 文件名唯一确定其内容，读取过的依赖声明缓存到磁盘
+    cache_file = METADATA_DIR / f"{name}.json"
+    if cache_file.exists():
+        try:
+            with cache_file.open("r", encoding="utf-8") as f:
+                return json.load(f)
+        except json.JSONDecodeError:
+            # 损坏的缓存按未缓存处理，重新读取并覆盖
+            pass
+
+    # 已下载的 wheel 直接读本地文件，否则只远程读取 METADATA
+    filepath = WHEELS_DIR / name
+    if filepath.exists():
+        metadata = read_wheel_metadata(filepath)
+    else:
+        try:
+            metadata = read_wheel_metadata(open_remote_file(url))
+        except (RequestException, ValueError):
+            # 镜像不支持 HEAD 或 Range 时下载到本地再读取，反正最后也要下载
+            filepath = download_package({"name": name, "url": url})
+            if filepath is None:
+                raise ValueError(f"Failed to download {name}")
+            metadata = read_wheel_metadata(filepath)
+    requires = read_wheel_requires(metadata)
+
+    METADATA_DIR.mkdir(parents=True, exist_ok=True)
+    write_file_atomic(cache_file, json.dumps(requires, indent=4).encode("utf-8"))
+    return requires
+
+
+def parse_wheel_requires(requires: dict) -> dict:
+    deps_str = requires["requires_dist"]
+    py_dep = requires["requires_python"]
     if py_dep is None:
         py_dep = ""
-    py_dep = SpecifierSet(py_dep)
+    py_dep = cached_specifier_set(py_dep)
 
     pkg_deps = []
     for dep in deps_str:
-        dep_sep = list(map(lambda x: x.strip(), dep.split(";")))
+        dep_sep = [s.strip() for s in dep.split(";")]
         parse_result = {
             "package_name": "",
             "package_extra": [],
@@ -83,13 +142,35 @@ def parse_wheels_dependency(filepath: Path) -> dict:
                 parse_result["package_extra"] = extra
                 parse_result["package_version"] = ver_spec
             else:
-                parse_result["package_markers"].append(Marker(s))
+                parse_result["package_markers"].append(cached_marker(s))
         assert parse_result["package_name"] != ""
         pkg_deps.append(parse_result)
 
     return py_dep, pkg_deps
 
 
+def parse_wheel_metadata(metadata: str) -> dict:
+    return parse_wheel_requires(read_wheel_requires(metadata))
+
+
+def parse_wheels_dependency(filepath: Path) -> dict:
+    return parse_wheel_metadata(read_wheel_metadata(filepath))
+
+
+@lru_cache(maxsize=None)
+def get_wheels_dependency_by_name(name: str, url: str) -> dict:
+    return parse_wheel_requires(load_wheel_requires(name, url))
+
+
+def get_wheels_dependency(data: dict) -> dict:
+    return get_wheels_dependency_by_name(data["name"], data["url"])
+
+
+def get_wheels_dependencies(datas: List[dict], max_workers: int = 16) -> List[dict]:
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        return list(executor.map(get_wheels_dependency, datas))
+
+
 if __name__ == "__main__":
     wheels_dir = Path("wheels")
     ss = set()
@@ -107,8 +188,8 @@ if __name__ == "__main__":
     print(SpecifierSet(py_dep).contains(Version("1.1")))
 
     # for wheel_file in wheels_dir.glob("*.whl"):
-    #     whl = pkginfo.wheel.Wheel(wheel_file)
-    #     requires_dist = whl.requires_dist
+    #     requires_dist = HeaderParser().parsestr(
+    #         read_wheel_metadata(wheel_file)).get_all("Requires-Dist", [])
     #     for dep in requires_dist:
     #         dep_sep = list(map(lambda x: x.strip(), dep.split(";")))
     #         parse_wheels_dependency_str0(dep_sep[0])
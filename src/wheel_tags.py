@@ -1,9 +1,10 @@
+from functools import lru_cache
 import json
 from pathlib import Path
 import sysconfig
-from typing import List
+from typing import FrozenSet, List, Tuple
 
-from packaging.tags import compatible_tags, cpython_tags, platform_tags
+from packaging.tags import Tag, compatible_tags, cpython_tags, platform_tags
 
 
 def dump_platforms():
@@ -16,19 +17,27 @@ def dump_platforms():
         json.dump(p_t, f, indent=4)
 
 
-def load_linux_x86_64_platforms() -> List[str]:
+# the platforms and tags of one environment never change, build them once
+@lru_cache(maxsize=None)
+def load_linux_x86_64_platforms() -> Tuple[str, ...]:
     with Path("platforms/linux_x86_64.json").open("r", encoding="utf-8") as f:
-        return json.load(f)
+        return tuple(json.load(f))
 
 
-def get_compat_wheel_tags(py_ver_str: str, plat_tags: List[str]) -> List[str]:
-    py_ver = tuple(map(int, py_ver_str.split(".")[0:2]))
-    cpy_tags = list(cpython_tags(
-        python_version=py_ver, platforms=plat_tags))
-    py_tags = list(compatible_tags(
+@lru_cache(maxsize=16)
+def build_compat_wheel_tags(py_ver: Tuple[int, ...], plat_tags: Tuple[str, ...]) -> FrozenSet[Tag]:
+    cpy_tags = cpython_tags(
+        python_version=py_ver, platforms=plat_tags)
+    py_tags = compatible_tags(
         python_version=py_ver,
-        interpreter=f"cp{py_ver[0]}{py_ver[1]}", platforms=plat_tags))
-    return cpy_tags + py_tags
+        interpreter=f"cp{py_ver[0]}{py_ver[1]}", platforms=plat_tags)
+    # only used for membership checks, a frozenset makes each one O(1)
+    return frozenset(cpy_tags) | frozenset(py_tags)
+
+
+def get_compat_wheel_tags(py_ver_str: str, plat_tags: List[str]) -> FrozenSet[Tag]:
+    py_ver = tuple(map(int, py_ver_str.split(".")[0:2]))
+    return build_compat_wheel_tags(py_ver, tuple(plat_tags))
 
 
 if __name__ == "__main__":